@@ -0,0 +1,72 @@
+from sympy import *
+
+# type in component param names here
+inputs = 'S E I R alpha beta sigma gamma epsilon mu t a t_on t_off'
+
+# ----------------
+outputs = {}
+inputs_unpacked = ', '.join(inputs.split())
+exec('%s = symbols("%s")' % (inputs_unpacked, inputs))
+exec('input_symbs = [%s]' % inputs_unpacked)
+# -----------------
+
+# paste compute() code here
+
+y = 1 / (1 + exp(-a*(t - t_on))) * 1 / (1 + exp(-a*(t_off - t)))
+
+theta = (beta - sigma)*y + (1 - y) * beta
+
+outputs['Sdot'] = -theta * S * I + epsilon * R
+outputs['Edot'] = theta * S * I - alpha * E
+outputs['Idot'] = alpha * E - gamma * I - mu * I
+outputs['Rdot'] = gamma * I - epsilon * R
+outputs['Ddot'] = mu * I
+outputs['theta'] = theta
+outputs['sigma_sq'] = sigma**2
+
+# ------------------
+# ------------------
+keys = []
+derivs = []
+for oname in outputs:
+    for iname in input_symbs:
+        deriv = diff(outputs[oname], iname)
+        if deriv != 0:
+            keys.append((oname, iname))
+            derivs.append(deriv)
+
+# collect the subexpressions shared between all of the partials
+replacements, reduced = cse(derivs)
+
+print()
+print("    def compute_partials(self, inputs, partials):\n")
+inputs_ns = ', '.join(["inputs['%s']" % inp for inp in inputs.split()])
+print("       ", inputs_unpacked, "=", inputs_ns )
+print()
+for symb, expr in replacements:
+    expr = 'np.exp'.join(str(expr).split('exp'))
+    print("\t\t%s = %s" % (symb, expr))
+
+declare = {}
+for (oname, iname), deriv in zip(keys, reduced):
+    if oname not in declare:
+        print()
+        declare[oname] = []
+    if deriv == 1:
+        deriv = 1.0
+
+    deriv = 'np.exp'.join(str(deriv).split('exp'))
+    st = "\t\tjacobian['%s', '%s'] = %s" % (oname, iname, deriv)
+    print(st)
+    declare[oname].append(iname)
+
+# declare partials
+# ------------------
+print("")
+print('\t\t' + 20*'#')
+print("\t\tarange = np.arange(self.options['num_nodes'], dtype=int)")
+for oname in declare:
+    list_inputs = ["'" + str(i) + "'" for i in declare[oname]]
+    list_inputs = ', '.join(list_inputs)
+    declare_statements = "\t\tself.declare_partials('%s', [%s], rows=arange, cols=arange)" % (oname, list_inputs)
+    print(declare_statements)
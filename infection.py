@@ -1,3 +1,4 @@
+import numba
 import numpy as np
 import openmdao.api as om
 
@@ -5,26 +6,151 @@ def KS(g, rho=50.0):
     """
     Kreisselmeier-Steinhauser constraint aggregation function.
     """
+    inv_rho = 1.0 / rho
+
+    if g.ndim == 1:
+        g_max = g.max()
+        exponents = np.exp(rho * (g - g_max))
+        summation = exponents.sum()
+
+        return g_max + inv_rho * np.log(summation), exponents / summation
+
     g_max = np.max(np.atleast_2d(g), axis=-1)[:, np.newaxis]
     g_diff = g - g_max
     exponents = np.exp(rho * g_diff)
     summation = np.sum(exponents, axis=-1)[:, np.newaxis]
 
-    KS = g_max + 1.0 / rho * np.log(summation)
+    KS = g_max + inv_rho * np.log(summation)
 
-    dsum_dg = rho * exponents
-    dKS_dsum = 1.0 / (rho * summation)
-    dKS_dg = dKS_dsum * dsum_dg
-
-    dsum_drho = np.sum(g_diff * exponents, axis=-1)[:, np.newaxis]
-    dKS_drho = dKS_dsum * dsum_drho
+    dKS_dg = exponents / summation
 
     return KS, dKS_dg.flatten()
 
+@numba.njit(fastmath=True, cache=True)
+def _ks_kernel(g, rho, out_grad):
+    """
+    Single-pass KS aggregation of a 1-D array. Writes dKS/dg into out_grad
+    and returns the aggregated value.
+    """
+    nn = g.shape[0]
+
+    g_max = g[0]
+    for i in range(1, nn):
+        if g[i] > g_max:
+            g_max = g[i]
+
+    s = 0.0
+    for i in range(nn):
+        out_grad[i] = np.exp(rho * (g[i] - g_max))
+        s += out_grad[i]
+
+    for i in range(nn):
+        out_grad[i] /= s
+
+    return g_max + np.log(s) / rho
+
+# outputs filled by _rhs_kernel, one row of the buffer each
+_RHS_OUTPUTS = ('Sdot', 'Edot', 'Idot', 'Rdot', 'Ddot', 'theta', 'sigma_sq')
+
+@numba.njit(fastmath=True, cache=True)
+def _rhs_kernel(S, E, I, R, alpha, beta, sigma, gamma, epsilon, mu, t,
+                a, t_on, t_off, y_on, y_off, out):
+    """
+    Fills out[k] with the output _RHS_OUTPUTS[k] in a single pass over the
+    nodes, and y_on/y_off with the switch values for _jac_kernel.
+    """
+    for i in numba.prange(t.shape[0]):
+        y_on[i] = 0.5 * (1.0 + np.tanh(0.5 * a * (t[i] - t_on)))
+        y_off[i] = 0.5 * (1.0 + np.tanh(0.5 * a * (t_off - t[i])))
+        theta = beta[i] - sigma[i] * y_on[i] * y_off[i]
+        theta_SI = theta * S[i] * I[i]
+
+        out[0, i] = -theta_SI + epsilon[i] * R[i]
+        out[1, i] = theta_SI - alpha[i] * E[i]
+        out[2, i] = alpha[i] * E[i] - (gamma[i] + mu[i]) * I[i]
+        out[3, i] = gamma[i] * I[i] - epsilon[i] * R[i]
+        out[4, i] = mu[i] * I[i]
+        out[5, i] = theta
+        out[6, i] = sigma[i] * sigma[i]
+
+_rhs_kernel_parallel = numba.njit(fastmath=True, parallel=True)(_rhs_kernel.py_func)
+
+# diagonal Jacobian entries filled by _jac_kernel, one row of the buffer each
+_JAC_ENTRIES = (('Sdot', 'beta'), ('Sdot', 'sigma'), ('Sdot', 'S'),
+                ('Sdot', 'I'), ('Sdot', 'a'), ('Sdot', 't_on'),
+                ('Sdot', 't_off'), ('Sdot', 't'),
+                ('Edot', 'beta'), ('Edot', 'sigma'), ('Edot', 'S'),
+                ('Edot', 'E'), ('Edot', 'I'), ('Edot', 'a'),
+                ('Edot', 't_on'), ('Edot', 't_off'), ('Edot', 't'),
+                ('Edot', 'alpha'),
+                ('Idot', 'mu'), ('Idot', 'gamma'), ('Idot', 'I'),
+                ('Rdot', 'epsilon'), ('Rdot', 'R'),
+                ('theta', 'sigma'), ('theta', 'a'), ('theta', 't_on'),
+                ('theta', 't_off'), ('theta', 't'),
+                ('sigma_sq', 'sigma'))
+
+@numba.njit(fastmath=True, cache=True)
+def _jac_kernel(S, E, I, R, alpha, beta, sigma, gamma, epsilon, mu, t,
+                a, t_on, t_off, y_on, y_off, out):
+    """
+    Fills out[k] with the Jacobian entry _JAC_ENTRIES[k] in a single pass over
+    the nodes, using theta = beta - sigma*y.
+    """
+    for i in numba.prange(t.shape[0]):
+        y = y_on[i] * y_off[i]
+        A = y * (1.0 - y_on[i])
+        B = y * (1.0 - y_off[i])
+        IS = I[i] * S[i]
+        theta = beta[i] - sigma[i] * y
+
+        dtheta_da = sigma[i] * ((t_on - t[i]) * A + (t[i] - t_off) * B)
+        dtheta_dt_on = sigma[i] * a * A
+        dtheta_dt_off = -sigma[i] * a * B
+        dtheta_dt = sigma[i] * a * (B - A)
+
+        out[0, i] = -IS
+        out[1, i] = IS * y
+        out[2, i] = -I[i] * theta
+        out[3, i] = -S[i] * theta
+        out[4, i] = -IS * dtheta_da
+        out[5, i] = -IS * dtheta_dt_on
+        out[6, i] = -IS * dtheta_dt_off
+        out[7, i] = -IS * dtheta_dt
+
+        out[8, i] = IS
+        out[9, i] = -IS * y
+        out[10, i] = I[i] * theta
+        out[11, i] = -alpha[i]
+        out[12, i] = S[i] * theta
+        out[13, i] = IS * dtheta_da
+        out[14, i] = IS * dtheta_dt_on
+        out[15, i] = IS * dtheta_dt_off
+        out[16, i] = IS * dtheta_dt
+        out[17, i] = -E[i]
+
+        out[18, i] = -I[i]
+        out[19, i] = -I[i]
+        out[20, i] = -gamma[i] - mu[i]
+
+        out[21, i] = -R[i]
+        out[22, i] = -epsilon[i]
+
+        out[23, i] = -y
+        out[24, i] = dtheta_da
+        out[25, i] = dtheta_dt_on
+        out[26, i] = dtheta_dt_off
+        out[27, i] = dtheta_dt
+
+        out[28, i] = 2.0 * sigma[i]
+
+_jac_kernel_parallel = numba.njit(fastmath=True, parallel=True)(_jac_kernel.py_func)
+
 class Infection(om.ExplicitComponent):
 
     def initialize(self):
         self.options.declare('num_nodes', types=int)
+        self.options.declare('parallel', types=bool, default=False,
+                             desc='run the compiled kernels threaded over the nodes')
 
     def setup(self):
         nn = self.options['num_nodes']
@@ -90,6 +216,26 @@ class Infection(om.ExplicitComponent):
 
         self.add_output('sigma_sq', np.zeros(nn))
 
+        if self.options['parallel']:
+            self._rhs_kernel = _rhs_kernel_parallel
+            self._jac_kernel = _jac_kernel_parallel
+        else:
+            self._rhs_kernel = _rhs_kernel
+            self._jac_kernel = _jac_kernel
+
+        self._ks_grad = np.zeros(nn)
+        self._jac_buf = np.zeros((len(_JAC_ENTRIES), nn))
+
+        self._rhs_buf = np.zeros((len(_RHS_OUTPUTS), nn))
+        self._y_on = np.zeros(nn)
+        self._y_off = np.zeros(nn)
+        self._I_cut = np.zeros(nn)
+
+        # work arrays for the complex-step evaluation of compute
+        names = ('I', 'y', 'theta', 'tmp1', 'tmp2')
+        self._scratch_cs = {name: np.zeros(nn, dtype=complex) for name in names}
+        self._scratch_cs['switch'] = np.zeros(2 * nn, dtype=complex)
+
         arange = np.arange(self.options['num_nodes'], dtype=int)
 
         self.declare_partials('Sdot', ['beta', 'sigma', 'epsilon', 'S', 'I', 'R', 't'], rows=arange, cols=arange)
@@ -103,104 +249,120 @@ class Infection(om.ExplicitComponent):
 
         self.declare_partials('Ddot', ['mu', 'I'], rows=arange, cols=arange)
 
-        self.declare_partials('theta', ['beta', 'sigma', 't'], rows=arange, cols=arange)
+        self.declare_partials('theta', 'beta', rows=arange, cols=arange, val=1.0)
+        self.declare_partials('theta', ['sigma', 't'], rows=arange, cols=arange)
         self.declare_partials('theta', ['a', 't_on', 't_off'])
 
         self.declare_partials('sigma_sq', ['sigma'], rows=arange, cols=arange)
         self.declare_partials('max_I', 'I')
 
     def compute(self, inputs, outputs):
-        beta, sigma, mu, epsilon, gamma, S, E, I, R, a, t_on, t_off, t, alpha = inputs['beta'], inputs['sigma'], inputs['mu'], inputs['epsilon'], inputs['gamma'], inputs['S'], inputs['E'], inputs['I'], inputs['R'], inputs['a'], inputs['t_on'], inputs['t_off'], inputs['t'], inputs['alpha']
+        beta, sigma, mu, epsilon, gamma, S, E, I, R, a, t_on, t_off, t, alpha = inputs['beta'], inputs['sigma'], inputs['mu'], inputs['epsilon'], inputs['gamma'], inputs['S'], inputs['E'], inputs['I'], inputs['R'], inputs['a'][0], inputs['t_on'][0], inputs['t_off'][0], inputs['t'], inputs['alpha']
         
-        # determine a cut-off where the infection is gone
-        I[np.where(I < 1e-4)] = 0.0
-        #E[np.where(E < 1e-6)] = 0.0
+        # determine a cut-off where the infection is gone, applied to a copy
+        # since I is a view of the framework's input vector
+        I_cut = self._scratch_cs['I'] if self.under_complex_step else self._I_cut
+        np.copyto(I_cut, I)
+        I_cut[I_cut < 1e-4] = 0.0
+        I = I_cut
+        #E[E < 1e-6] = 0.0
+
+        # the real inputs and y_on/y_off are reused by compute_partials, which
+        # always follows compute at the same point
+        if not self.under_complex_step:
+            self._input_vals = beta, sigma, mu, epsilon, gamma, S, E, I, R, a, t_on, t_off, t, alpha
+
+            self._rhs_kernel(S, E, I, R, alpha, beta, sigma, gamma, epsilon, mu, t,
+                             a, t_on, t_off, self._y_on, self._y_off, self._rhs_buf)
+
+            for name, val in zip(_RHS_OUTPUTS, self._rhs_buf):
+                outputs[name] = val
+
+            outputs['max_I'] = _ks_kernel(I, 50.0, self._ks_grad)
+            return
+
+        # the compiled kernels are real-only, complex step goes through NumPy
+        work = self._scratch_cs
+        switch, y, theta = work['switch'], work['y'], work['theta']
+        tmp1, tmp2 = work['tmp1'], work['tmp2']
+        nn = self.options['num_nodes']
 
-        # fix numerical overflow
-        d_ton = np.exp(-a*(t - t_on))
-        d_toff = np.exp(-a*(-t + t_off))
+        # logistic switches written with tanh, which cannot overflow and
+        # (unlike scipy's expit) also takes complex step
+        # y_on = 0.5*(1 + tanh(a*(t - t_on)/2)), y_off = 0.5*(1 + tanh(a*(t_off - t)/2))
+        # both evaluated with a single tanh call over the stacked arguments
+        y_on, y_off = switch[:nn], switch[nn:]
+        np.subtract(t, t_on, out=y_on)
+        np.subtract(t_off, t, out=y_off)
+        switch *= 0.5 * a
+        np.tanh(switch, out=switch)
+        switch += 1.0
+        switch *= 0.5
+
+        np.multiply(y_on, y_off, out=y)
+
+        # theta = (beta - sigma)*y + (1 - y)*beta = beta - sigma*y
+        np.multiply(sigma, y, out=theta)
+        np.subtract(beta, theta, out=theta)
+
+        agg_i, _ = KS(I)
+        outputs['max_I'] = np.sum(agg_i)
 
-        d_ton[np.where(d_ton > 1.e10)] = 1.e10
-        d_toff[np.where(d_toff > 1.e10)] = 1.e10
+        np.multiply(sigma, sigma, out=tmp1)
+        outputs['sigma_sq'] = tmp1
 
-        y = 1 / (1 + d_ton) * 1 / (1 + d_toff) 
+        outputs['theta'] = theta
 
-        theta = (beta - sigma)*y + (1 - y) * beta
+        # tmp1 = theta*S*I
+        np.multiply(S, I, out=tmp1)
+        tmp1 *= theta
 
-        agg_i, self.dagg_i = KS(I)
-        outputs['max_I'] = np.sum(agg_i)
+        # Sdot = -theta*S*I + epsilon*R
+        np.multiply(epsilon, R, out=tmp2)
+        tmp2 -= tmp1
+        outputs['Sdot'] = tmp2
 
-        outputs['sigma_sq'] = sigma**2
+        # Edot = theta*S*I - alpha*E
+        np.multiply(alpha, E, out=tmp2)
+        np.subtract(tmp1, tmp2, out=tmp2)
+        outputs['Edot'] = tmp2
 
-        outputs['theta'] = theta
+        # Idot = alpha*E - (gamma + mu)*I
+        np.add(gamma, mu, out=tmp1)
+        tmp1 *= I
+        np.multiply(alpha, E, out=tmp2)
+        tmp2 -= tmp1
+        outputs['Idot'] = tmp2
+
+        # Rdot = gamma*I - epsilon*R
+        np.multiply(gamma, I, out=tmp1)
+        np.multiply(epsilon, R, out=tmp2)
+        tmp1 -= tmp2
+        outputs['Rdot'] = tmp1
 
-        outputs['Sdot'] = -theta * S * I + epsilon * R
-        outputs['Edot'] = theta * S * I - alpha * E
-        outputs['Idot'] = alpha * E - gamma * I - mu * I
-        outputs['Rdot'] = gamma * I - epsilon * R
-        outputs['Ddot'] = mu * I
+        np.multiply(mu, I, out=tmp1)
+        outputs['Ddot'] = tmp1
 
     def compute_partials(self, inputs, jacobian):
-        beta, sigma, mu, epsilon, gamma, S, E, I, R, a, t_on, t_off, t, alpha = inputs['beta'], inputs['sigma'], inputs['mu'], inputs['epsilon'], inputs['gamma'], inputs['S'], inputs['E'], inputs['I'], inputs['R'], inputs['a'], inputs['t_on'], inputs['t_off'], inputs['t'], inputs['alpha']
-        
-        # determine a cut-off where the infection is gone
-        I[np.where(I < 1e-4)] = 0.0
-        #E[np.where(E < 1e-6)] = 0.0
+        beta, sigma, mu, epsilon, gamma, S, E, I, R, a, t_on, t_off, t, alpha = self._input_vals
 
-        # fix numerical overflow
-        d_ton = np.exp(-a*(t - t_on))
-        d_toff = np.exp(-a*(-t + t_off))
+        self._jac_kernel(S, E, I, R, alpha, beta, sigma, gamma, epsilon, mu, t,
+                         a, t_on, t_off, self._y_on, self._y_off, self._jac_buf)
 
-        d_ton[np.where(d_ton > 1.e10)] = 1.e10
-        d_toff[np.where(d_toff > 1.e10)] = 1.e10
+        for key, val in zip(_JAC_ENTRIES, self._jac_buf):
+            jacobian[key] = val
 
-        jacobian['Sdot', 'beta'] = -I*S
-        jacobian['Sdot', 'sigma'] = I*S/((1 + d_toff)*(1 + d_ton))
+        # entries that are just an input are copied straight from it
         jacobian['Sdot', 'epsilon'] = R
-        jacobian['Sdot', 'S'] = I*(-beta*(1 - 1/((1 + d_toff)*(1 + d_ton))) - (beta - sigma)/((1 + d_toff)*(1 + d_ton)))
-        jacobian['Sdot', 'I'] = S*(-beta*(1 - 1/((1 + d_toff)*(1 + d_ton))) - (beta - sigma)/((1 + d_toff)*(1 + d_ton)))
         jacobian['Sdot', 'R'] = epsilon
-        jacobian['Sdot', 'a'] = I*S*(-beta*((-t + t_on)*d_ton/((1 + d_toff)*(1 + d_ton)**2) + (t - t_off)*d_toff/((1 + d_toff)**2*(1 + d_ton))) + (beta - sigma)*(-t + t_on)*d_ton/((1 + d_toff)*(1 + d_ton)**2) + (beta - sigma)*(t - t_off)*d_toff/((1 + d_toff)**2*(1 + d_ton)))
-        jacobian['Sdot', 't_on'] = I*S*(-a*beta*d_ton/((1 + d_toff)*(1 + d_ton)**2) + a*(beta - sigma)*d_ton/((1 + d_toff)*(1 + d_ton)**2))
-        jacobian['Sdot', 't_off'] = I*S*(a*beta*d_toff/((1 + d_toff)**2*(1 + d_ton)) - a*(beta - sigma)*d_toff/((1 + d_toff)**2*(1 + d_ton)))
-        jacobian['Sdot', 't'] = I*S*(-a*(beta - sigma)*d_ton/((1 + d_toff)*(1 + d_ton)**2) + a*(beta - sigma)*d_toff/((1 + d_toff)**2*(1 + d_ton)) - beta*(-a*d_ton/((1 + d_toff)*(1 + d_ton)**2) + a*d_toff/((1 + d_toff)**2*(1 + d_ton))))
-
-        jacobian['Edot', 'beta'] = I*S
-        jacobian['Edot', 'sigma'] = -I*S/((1 + d_toff)*(1 + d_ton))
-        jacobian['Edot', 'S'] = I*(beta*(1 - 1/((1 + d_toff)*(1 + d_ton))) + (beta - sigma)/((1 + d_toff)*(1 + d_ton)))
-        jacobian['Edot', 'E'] = -alpha
-        jacobian['Edot', 'I'] = S*(beta*(1 - 1/((1 + d_toff)*(1 + d_ton))) + (beta - sigma)/((1 + d_toff)*(1 + d_ton)))
-        jacobian['Edot', 'a'] = I*S*(beta*((-t + t_on)*d_ton/((1 + d_toff)*(1 + d_ton)**2) + (t - t_off)*d_toff/((1 + d_toff)**2*(1 + d_ton))) - (beta - sigma)*(-t + t_on)*d_ton/((1 + d_toff)*(1 + d_ton)**2) - (beta - sigma)*(t - t_off)*d_toff/((1 + d_toff)**2*(1 + d_ton)))
-        jacobian['Edot', 't_on'] = I*S*(a*beta*d_ton/((1 + d_toff)*(1 + d_ton)**2) - a*(beta - sigma)*d_ton/((1 + d_toff)*(1 + d_ton)**2))
-        jacobian['Edot', 't_off'] = I*S*(-a*beta*d_toff/((1 + d_toff)**2*(1 + d_ton)) + a*(beta - sigma)*d_toff/((1 + d_toff)**2*(1 + d_ton)))
-        jacobian['Edot', 't'] = I*S*(a*(beta - sigma)*d_ton/((1 + d_toff)*(1 + d_ton)**2) - a*(beta - sigma)*d_toff/((1 + d_toff)**2*(1 + d_ton)) + beta*(-a*d_ton/((1 + d_toff)*(1 + d_ton)**2) + a*d_toff/((1 + d_toff)**2*(1 + d_ton))))
-        jacobian['Edot', 'alpha'] = -E
-
-        jacobian['Idot', 'mu'] = -I
-        jacobian['Idot', 'gamma'] = -I
         jacobian['Idot', 'E'] = alpha
-        jacobian['Idot', 'I'] = -gamma - mu
         jacobian['Idot', 'alpha'] = E
-
         jacobian['Rdot', 'gamma'] = I
-        jacobian['Rdot', 'epsilon'] = -R
         jacobian['Rdot', 'I'] = gamma
-        jacobian['Rdot', 'R'] = -epsilon
-
         jacobian['Ddot', 'mu'] = I
         jacobian['Ddot', 'I'] = mu
 
-
-        jacobian['theta', 'beta'] = 1.0
-        jacobian['theta', 'sigma'] = -1/((1 + d_toff)*(1 + d_ton))
-        jacobian['theta', 'a'] = beta*((-t + t_on)*d_ton/((1 + d_toff)*(1 + d_ton)**2) + (t - t_off)*d_toff/((1 + d_toff)**2*(1 + d_ton))) - (beta - sigma)*(-t + t_on)*d_ton/((1 + d_toff)*(1 + d_ton)**2) - (beta - sigma)*(t - t_off)*d_toff/((1 + d_toff)**2*(1 + d_ton))
-        jacobian['theta', 't_on'] = a*beta*d_ton/((1 + d_toff)*(1 + d_ton)**2) - a*(beta - sigma)*d_ton/((1 + d_toff)*(1 + d_ton)**2)
-        jacobian['theta', 't_off'] = -a*beta*d_toff/((1 + d_toff)**2*(1 + d_ton)) + a*(beta - sigma)*d_toff/((1 + d_toff)**2*(1 + d_ton))
-        jacobian['theta', 't'] = a*(beta - sigma)*d_ton/((1 + d_toff)*(1 + d_ton)**2) - a*(beta - sigma)*d_toff/((1 + d_toff)**2*(1 + d_ton)) + beta*(-a*d_ton/((1 + d_toff)*(1 + d_ton)**2) + a*d_toff/((1 + d_toff)**2*(1 + d_ton)))
-
-        jacobian['max_I', 'I'] = self.dagg_i
-
-        jacobian['sigma_sq', 'sigma'] = 2.0 * sigma
+        jacobian['max_I', 'I'] = self._ks_grad
 
 if __name__ == '__main__':
   